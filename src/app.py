@@ -1,55 +1,81 @@
-from functools import lru_cache
-from urllib.parse import urlencode
+import hashlib
+import os
+import threading
+from urllib.parse import urlparse
 
 import dash
 import dash_bootstrap_components as dbc
 import flask
 import inflect
 import numpy as np
-import pandas as pd
 import plotly.graph_objs as go
-from dash import Input, Output, State, ctx, dcc, html
+import pyarrow as pa
+from dash import ClientsideFunction, Input, Output, State, ctx, dcc, html
 from dash.exceptions import PreventUpdate
 
-from app_util import apply_default_value, dash_kwarg, parse_state
+from app_util import (StateCodec, apply_default_value, dash_kwarg, stream_csv,
+                      stream_parquet)
+from cache import LRUCache, cached, make_cache
+from export import ExportQueueFull, ExportRenderer
+from metrics import Metrics
 from process_data import *
 
 p = inflect.engine()
 
-data_2021 = process_census_data(
-    "data/teacher_pay_2021.csv",
-    column_mapping_2021,
-    incp_low_mapping_2021,
-    incp_high_mapping_2021,
+# Only the latest year is loaded at startup, others on first use
+census_years = CensusYears(maxsize=int(os.environ.get("LOADED_YEARS", 2)))
+
+# Changes whenever the precomputed percentiles change. Shared sqlite caches
+# written under another version are cleared on startup.
+dataset_version = pcntiles_digest()
+
+export_schema = pa.schema(
+    [
+        ("YEAR", pa.int16()),
+        ("STATE", pa.string()),
+        ("OCCP4D", pa.string()),
+        ("AGE10P", pa.string()),
+        ("PERCENTILE", pa.int8()),
+        ("PERCENTILE_VALUE", pa.float64()),
+    ]
+)
+
+# Lookups stay in memory, unpickling a table from sqlite costs more than
+# selecting it again
+pcntile_cache = LRUCache(
+    maxsize=int(os.environ.get("PCNTILE_CACHE_SIZE", 1024)),
+    eviction=os.environ.get("PCNTILE_CACHE_EVICTION", "lru"),
 )
-data_2021["YEAR"] = 2021
 
-data_2016 = process_census_data(
-    "data/teacher_pay_2016.csv",
-    column_mapping_2016,
-    incp_low_mapping_2016,
-    incp_high_mapping_2016,
+figure_cache = make_cache(
+    os.environ.get("FIGURE_CACHE", "memory"),
+    maxsize=int(os.environ.get("FIGURE_CACHE_SIZE", 256)),
+    path=os.environ.get("FIGURE_CACHE_PATH", "data/figure_cache.sqlite"),
+    version=dataset_version,
 )
-data_2016["YEAR"] = 2016
 
-data_2011 = process_census_data(
-    "data/teacher_pay_2011.csv",
-    column_mapping_2011,
-    incp_low_mapping_2011,
-    incp_high_mapping_2011,
+export_cache = make_cache(
+    os.environ.get("EXPORT_CACHE", "memory"),
+    maxsize=int(os.environ.get("EXPORT_CACHE_SIZE", 64)),
+    path=os.environ.get("EXPORT_CACHE_PATH", "data/export_cache.sqlite"),
+    version=dataset_version,
 )
-data_2011["YEAR"] = 2011
 
-data_2006 = process_census_data(
-    "data/teacher_pay_2006.csv",
-    column_mapping_2006,
-    incp_low_mapping_2006,
-    incp_high_mapping_2006,
+export_renderer = ExportRenderer(
+    os.environ.get("EXPORT_LOCK_PATH", "data/export"),
+    max_concurrent=int(os.environ.get("EXPORT_CONCURRENCY", 1)),
+    max_queued=int(os.environ.get("EXPORT_QUEUE_SIZE", 4)),
+    wait=float(os.environ.get("EXPORT_WAIT", 10)),
 )
-data_2006["YEAR"] = 2006
 
-data = pd.concat([data_2021, data_2016, data_2011, data_2006], axis=0)
-combinations = data[["OCCP4D", "AGE10P", "STATE", "YEAR"]].drop_duplicates()
+# Component trees can't be shared between processes so layouts stay in memory
+layout_cache = LRUCache(maxsize=int(os.environ.get("LAYOUT_CACHE_SIZE", 256)))
+
+metrics = Metrics(enabled=os.environ.get("METRICS", "0") == "1")
+metrics.add_cache("pcntile", pcntile_cache)
+metrics.add_cache("figure", figure_cache)
+metrics.add_cache("export", export_cache)
+metrics.add_cache("layout", layout_cache)
 
 states_australia = [
     "All",
@@ -65,10 +91,33 @@ states_australia = [
 
 scale_options = {"Annual": 52, "Weekly": 1}
 
-years = pd.Series(combinations["YEAR"].unique()).sort_values(ascending=True)
-latest_year = combinations["YEAR"].iloc[0]
+percentile_options = list(range(10, 100, 10))
+
+# Send percentile tables to the browser once and redraw the figure there when
+# only the percentile or scale changes
+clientside_rendering = os.environ.get("CLIENTSIDE_RENDERING", "0") == "1"
+
+years = census_years.years
+latest_year = census_years.latest
+
+
+# Dropdown options per census year, built once per year
+@cached(LRUCache(maxsize=len(years)))
+def occ_options(year):
+    return [{"label": x, "value": x} for x in census_years.occupations(year)]
 
-occs_latest = data.query(f"YEAR == {latest_year}")["OCCP4D"].unique()
+
+@cached(LRUCache(maxsize=len(years)))
+def occ_set(year):
+    return frozenset(census_years.occupations(year))
+
+
+state_codec = StateCodec(
+    states_australia,
+    scale_options.keys(),
+    percentile_options,
+    census_years.occupations,
+)
 
 occs_default_selected = [
     "Secondary School Teachers",
@@ -169,12 +218,12 @@ instructions = dbc.Row(
 
 
 def build_layout(params):
+    year = latest_year if "dropdown_year" not in params else params["dropdown_year"]
+
     return [
         dcc.Store(
             id="store_year",
-            data=latest_year
-            if "dropdown_year" not in params
-            else params["dropdown_year"],
+            data=year,
         ),
         dbc.Card(
             [
@@ -204,7 +253,7 @@ def build_layout(params):
                                             clearable=False,
                                             options=[
                                                 {"label": x, "value": x}
-                                                for x in np.arange(10, 100, 10)
+                                                for x in percentile_options
                                             ],
                                         ),
                                     ],
@@ -261,10 +310,7 @@ def build_layout(params):
                                         dbc.Label("Occupations"),
                                         apply_default_value(params)(dcc.Dropdown)(
                                             id="checkbox_occupations",
-                                            options=[
-                                                {"label": x, "value": x}
-                                                for x in np.sort(occs_latest)
-                                            ],
+                                            options=occ_options(int(year)),
                                             value=occs_default_selected,
                                             multi=True,
                                             clearable=True,
@@ -285,6 +331,7 @@ def build_layout(params):
 app.layout = html.Div(
     [
         dcc.Location(id="url", refresh=False),
+        dcc.Store(id="store_pcntiles"),
         dcc.ConfirmDialog(
             id="confirm",
             message="Changing years will reset occupation selections to default values. Are you sure you want to continue?",
@@ -323,6 +370,14 @@ app.layout = html.Div(
                                         ),
                                         dbc.CardBody(
                                             [
+                                                dbc.Alert(
+                                                    "Image export is busy, please try again in a moment.",
+                                                    id="alert_export_busy",
+                                                    color="warning",
+                                                    is_open=False,
+                                                    dismissable=True,
+                                                    duration=5000,
+                                                ),
                                                 dcc.Graph(
                                                     id="graph",
                                                     config={
@@ -330,7 +385,7 @@ app.layout = html.Div(
                                                         "staticPlot": False,
                                                         "responsive": True,
                                                     },
-                                                )
+                                                ),
                                             ]
                                         ),
                                     ]
@@ -370,11 +425,16 @@ graph_states = [State(x[0], x[1]) for x in components]
     Output("page-layout", "children"),
     inputs=[Input("url", "href")],
 )
+@metrics.callback("page_load")
 def page_load(href):
     if not href:
         return []
-    state = parse_state(href)
-    return build_layout(state)
+    return cached_layout(state_codec.normalise(urlparse(href).query))
+
+
+@cached(layout_cache)
+def cached_layout(query):
+    return build_layout(state_codec.decode(query))
 
 
 @app.callback(
@@ -384,78 +444,30 @@ def page_load(href):
 # Add dash kward arg here
 @dash_kwarg(graph_inputs)
 def update_url_state(**kwargs):
-    state = urlencode(kwargs)
+    state = state_codec.encode(
+        kwargs["dropdown_state"],
+        kwargs["dropdown_percentile"],
+        kwargs["store_year"],
+        kwargs["dropdown_scale"],
+        kwargs["checkbox_occupations"],
+    )
     return f"?{state}"
 
 
-@lru_cache(maxsize=128)
+@cached(pcntile_cache)
+@metrics.stage("get_pcntiles")
 def get_pcntiles(state, year, occupation):
-    pcntile_range = np.arange(0, 101, 10).reshape(-1, 1) / 100
-
-    combins = combinations.query(
-        f"STATE == '{state}' and OCCP4D == '{occupation}' and YEAR == {year}"
-    )
-    results = []
-    for idx, row in combins.iterrows():
-        year = row["YEAR"]
-        occ = row["OCCP4D"]
-        age_group = row["AGE10P"]
-        state = row["STATE"]
-        subset = data.query(
-            f"OCCP4D == '{occ}' and AGE10P == '{age_group}' and STATE == '{state}' and YEAR == {year}"
-        )
-        subset = subset.sort_values("INCP_HIGH", ascending=True)
-
-        # If the subset has no observations then fill with 0
-        if subset["COUNT"].sum() > 0:
-            edges = subset["INCP_HIGH"].values
-            counts = subset["COUNT"].values
-
-            # Collapse zeros
-            idx = counts != 0
-            edges = edges[idx]
-            counts = counts[idx]
-            edges = np.concatenate(([0], edges))
-            counts = np.concatenate(([0], counts))
-
-            bs = BinSmooth()
-            bs.fit(
-                edges,
-                counts,
-                includes_tail=True,
-            )
-
-            pcntile_vals = bs.inv_cdf(pcntile_range)
-        else:
-            pcntile_vals = np.full(pcntile_range.shape, 0)
-
-        result = pd.concat(
-            [
-                pd.Series(
-                    (pcntile_range.squeeze() * 100).astype(int), name="PERCENTILE"
-                ),
-                pd.Series(pcntile_vals.squeeze().round(4), name="PERCENTILE_VALUE"),
-            ],
-            axis=1,
-        )
-
-        result["YEAR"] = year
-        result["OCCP4D"] = occ
-        result["AGE10P"] = age_group
-        result["STATE"] = state
-
-        results.append(result)
-
-    return pd.concat(results, axis=0)
+    return census_years.pcntiles(year).loc[(state, occupation)]
 
 
+@metrics.stage("figure_dict")
 def figure_dict(state, percentile, year, scale, occupations):
     plot_list = []
 
     for occ in occupations:
 
         line_data = (
-            get_pcntiles(state, year, occ)
+            get_pcntiles(state, int(year), occ)
             .query(f"PERCENTILE == {percentile}")
             .sort_values("AGE10P")
         )
@@ -492,12 +504,137 @@ def figure_dict(state, percentile, year, scale, occupations):
     return {"data": plot_list, "layout": layout}
 
 
-@app.callback(
-    Output(component_id="graph", component_property="figure"),
-    inputs=graph_inputs,
-)
-def update_graph(*args):
-    return figure_dict(*args)
+def cached_figure(state, percentile, year, scale, occupations):
+    occupations = occupations or []
+
+    # Selections that only differ in occupation order share an entry
+    key = (state, int(percentile), int(year), scale, tuple(sorted(set(occupations))))
+    fig = figure_cache.get(key)
+    if fig is None:
+        fig = figure_dict(*key[:4], key[4])
+        with metrics.time("figure_serialize"):
+            fig = {
+                "data": [trace.to_plotly_json() for trace in fig["data"]],
+                "layout": fig["layout"].to_plotly_json(),
+            }
+        figure_cache.set(key, fig)
+
+    # Restore the selected order so trace colours match an uncached render
+    traces = {trace["name"]: trace for trace in fig["data"]}
+    return {"data": [traces[occ] for occ in occupations], "layout": fig["layout"]}
+
+
+def pcntile_tables(state, year, occupations):
+    tables = []
+    for occ in occupations or []:
+        table = get_pcntiles(state, int(year), occ)
+        table = table.assign(AGE10P=table["AGE10P"].astype(str)).pivot(
+            index="PERCENTILE", columns="AGE10P", values="PERCENTILE_VALUE"
+        )
+
+        tables.append(
+            {
+                "name": occ,
+                "x": list(table.columns),
+                "y": {int(k): list(v) for k, v in table.iterrows()},
+            }
+        )
+
+    return {"year": year, "scale_options": scale_options, "tables": tables}
+
+
+if clientside_rendering:
+
+    @app.callback(
+        Output("store_pcntiles", "data"),
+        inputs=[
+            Input("dropdown_state", "value"),
+            Input("store_year", "data"),
+            Input("checkbox_occupations", "value"),
+        ],
+    )
+    def update_pcntiles_store(state, year, occupations):
+        return pcntile_tables(state, year, occupations)
+
+    app.clientside_callback(
+        ClientsideFunction(namespace="pcntiles", function_name="figure"),
+        Output(component_id="graph", component_property="figure"),
+        inputs=[
+            Input("store_pcntiles", "data"),
+            Input("dropdown_percentile", "value"),
+            Input("dropdown_scale", "value"),
+        ],
+    )
+
+else:
+
+    @app.callback(
+        Output(component_id="graph", component_property="figure"),
+        inputs=graph_inputs,
+    )
+    @metrics.callback("update_graph")
+    def update_graph(*args):
+        return cached_figure(*args)
+
+
+def env_list(name, default):
+    # Semicolon separated, occupation names can contain commas
+    value = os.environ.get(name)
+    if value is None:
+        return default
+
+    return [x.strip() for x in value.split(";") if x.strip()]
+
+
+# Warming other years would load them, so only the latest year is warmed
+warmup_states = env_list("PCNTILE_WARMUP_STATES", states_australia)
+warmup_occupations = env_list("PCNTILE_WARMUP_OCCUPATIONS", occs_default_selected)
+
+warmup_selections = [
+    (state, int(latest_year), occ)
+    for state in warmup_states
+    for occ in warmup_occupations
+]
+
+# The landing figure of each warmed state, at the default percentile and scale
+warmup_figures = [
+    (state, 50, int(latest_year), list(scale_options.keys())[0], warmup_occupations)
+    for state in warmup_states
+]
+
+
+def warm_up(selections=warmup_selections, figures=warmup_figures):
+    for selection in selections:
+        try:
+            get_pcntiles(*selection)
+        except KeyError:
+            # Not every occupation exists in every census year
+            pass
+
+    # Figures are drawn in the browser with clientside rendering
+    if clientside_rendering:
+        return
+
+    for figure in figures:
+        try:
+            cached_figure(*figure)
+        except KeyError:
+            pass
+
+
+def start_background_warm_up():
+    threading.Thread(target=warm_up, daemon=True).start()
+
+
+warmup_mode = os.environ.get("PCNTILE_WARMUP", "preload")
+if warmup_mode == "preload":
+    # With gunicorn --preload this runs once in the master so that every
+    # forked worker starts with a hot cache
+    warm_up()
+
+# Background warm-up is started per worker by the post_fork hook in
+# gunicorn.conf.py. A thread started here would run in the preloaded master
+# and workers could fork while it holds a cache lock.
 
 
 @app.callback(
@@ -515,6 +652,7 @@ def update_graph(*args):
     state=[State("store_year", "data"), State("checkbox_occupations", "value")],
     prevent_initial_call=True,
 )
+@metrics.callback("year_change")
 @dash_kwarg(
     [
         Input("dropdown_year", "value"),
@@ -533,50 +671,33 @@ def year_change(**kwargs):
         # First the year dropdown gets changed
         if changed_id == "dropdown_year":
             if kwargs["dropdown_year"] != kwargs["store_year"]:
+                year = int(kwargs["dropdown_year"])
 
                 # Check if changing years will cause issues with occupations
-                occs_selected_set = set(kwargs["checkbox_occupations"])
-                occs_year_set = set(
-                    combinations.query(f"YEAR == {kwargs['dropdown_year']}")[
-                        "OCCP4D"
-                    ].unique()
-                )
-
-                if occs_selected_set.issubset(occs_year_set):
-                    occupations = combinations.query(
-                        f"YEAR == {kwargs['dropdown_year']}"
-                    )["OCCP4D"].unique()
-
+                if occ_set(year).issuperset(kwargs["checkbox_occupations"] or []):
                     return (
                         False,
                         "",
-                        [{"label": x, "value": x} for x in np.sort(occupations)],
+                        occ_options(year),
                         kwargs["checkbox_occupations"],
                         kwargs["dropdown_year"],
                     )
 
-                occupations = combinations.query(f"YEAR == {kwargs['store_year']}")[
-                    "OCCP4D"
-                ].unique()
-
                 message = f"The currently selected occupations are not available for {kwargs['dropdown_year']}.\n\n Changing years will reset occupation selections to default values. Are you sure you want to continue?"
 
                 return (
                     True,
                     message,
-                    [{"label": x, "value": x} for x in np.sort(occupations)],
+                    occ_options(int(kwargs["store_year"])),
                     kwargs["checkbox_occupations"],
                     kwargs["store_year"],
                 )
 
         elif changed_id == "confirm":
-            occupations = combinations.query(f"YEAR == {kwargs['dropdown_year']}")[
-                "OCCP4D"
-            ].unique()
             return (
                 False,
                 "",
-                [{"label": x, "value": x} for x in np.sort(occupations)],
+                occ_options(int(kwargs["dropdown_year"])),
                 occs_default_selected,
                 kwargs["dropdown_year"],
             )
@@ -597,27 +718,168 @@ def year_cancel(**kwargs):
 
 @app.callback(
     *(
-        [Output("download_plot", "data"), Input("button_download", "n_clicks")]
+        [
+            Output("download_plot", "data"),
+            Output("alert_export_busy", "is_open"),
+            Input("button_download", "n_clicks"),
+        ]
         + graph_states
     ),
     prevent_initial_call=True,
 )
-def download_plot(button_nclicks, *args):
-
-    fig = figure_dict(*args)
+@metrics.callback("download_plot")
+def download_plot(button_nclicks, state, percentile, year, scale, occupations):
 
     w, h = 800, 600
     format = "png"
 
-    img_bytes = go.Figure(fig).to_image(
-        format=format,
-        width=w,
-        height=h,
-        scale=2,
+    key = (state, int(percentile), int(year), scale, tuple(occupations or []), format)
+    img_bytes = export_cache.get(key)
+    if img_bytes is None:
+        fig = cached_figure(state, percentile, year, scale, occupations)
+
+        try:
+            with metrics.time("export_render"):
+                img_bytes = export_renderer.render(
+                    fig, format=format, width=w, height=h
+                )
+        except ExportQueueFull:
+            # Too many exports are waiting, ask the user to retry
+            return dash.no_update, True
+
+        export_cache.set(key, img_bytes)
+
+    return dcc.send_bytes(img_bytes, filename="download.png"), False
+
+
+def pcntile_chunks(years=None, states=None, occupations=None, percentiles=None):
+    # One year is read at a time and written out one chunk per (year, state)
+    # so that exports never hold the full table
+    for year in census_years.years:
+        if years and year not in years:
+            continue
+
+        table = census_years.scan(year, states)
+        for state in table.index.unique("STATE"):
+            chunk = table.loc[state]
+            if occupations:
+                chunk = chunk[chunk.index.isin(occupations)]
+            if percentiles:
+                chunk = chunk[chunk["PERCENTILE"].isin(percentiles)]
+            if chunk.empty:
+                continue
+
+            chunk = chunk.reset_index().astype({"OCCP4D": str, "AGE10P": str})
+            chunk.insert(0, "YEAR", year)
+            chunk.insert(1, "STATE", state)
+
+            yield chunk
+
+
+@server.route("/export/pcntiles.<format>")
+def export_pcntiles(format):
+    args = flask.request.args
+    try:
+        chunks = pcntile_chunks(
+            years=[int(x) for x in args.getlist("year")],
+            states=args.getlist("state"),
+            occupations=args.getlist("occupation"),
+            percentiles=[int(x) for x in args.getlist("percentile")],
+        )
+    except ValueError:
+        flask.abort(400)
+
+    if format == "csv":
+        body = stream_csv(chunks, export_schema.names)
+        mimetype = "text/csv"
+    elif format == "parquet":
+        body = stream_parquet(chunks, export_schema)
+        mimetype = "application/vnd.apache.parquet"
+    else:
+        flask.abort(404)
+
+    return flask.Response(
+        flask.stream_with_context(body),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename=pcntiles.{format}"},
+    )
+
+
+def api_error(status, message):
+    response = flask.jsonify({"error": message})
+    response.status_code = status
+    return response
+
+
+@server.route("/api/v1/percentiles")
+def api_percentiles():
+    args = flask.request.args
+
+    missing = [x for x in ["year", "state", "occupation"] if x not in args]
+    if missing:
+        return api_error(400, f"Missing parameters: {', '.join(missing)}")
+
+    scale = args.get("scale", "Weekly")
+    if scale not in scale_options:
+        return api_error(400, f"Unknown scale: {scale}")
+
+    try:
+        year = int(args["year"])
+        percentiles = [int(x) for x in args.getlist("percentile")]
+    except ValueError:
+        return api_error(400, "year and percentile must be integers")
+
+    try:
+        table = get_pcntiles(args["state"], year, args["occupation"])
+    except KeyError:
+        return api_error(404, "No estimates for this year, state and occupation")
+
+    if percentiles:
+        table = table[table["PERCENTILE"].isin(percentiles)]
+    table = table.sort_values(["PERCENTILE", "AGE10P"])
+
+    response = flask.jsonify(
+        {
+            "version": dataset_version,
+            "year": year,
+            "state": args["state"],
+            "occupation": args["occupation"],
+            "scale": scale,
+            "percentiles": [
+                {
+                    "percentile": int(percentile),
+                    "values": dict(
+                        zip(
+                            group["AGE10P"].astype(str),
+                            group["PERCENTILE_VALUE"] * scale_options[scale],
+                        )
+                    ),
+                }
+                for percentile, group in table.groupby("PERCENTILE", sort=True)
+            ],
+        }
     )
 
-    return dcc.send_bytes(img_bytes, filename="download.png")
+    # Responses only change with the dataset, so a proxy can serve repeats
+    etag = hashlib.sha256(
+        f"{dataset_version}{flask.request.full_path}".encode()
+    ).hexdigest()[:32]
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = int(os.environ.get("API_MAX_AGE", 86400))
+
+    return response.make_conditional(flask.request)
+
+
+if metrics.enabled:
+
+    @server.route("/metrics")
+    def metrics_endpoint():
+        return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
+    if warmup_mode == "background":
+        start_background_warm_up()
+
     app.run_server(debug=True)
@@ -1,6 +1,11 @@
 import ast
+import hashlib
+import io
 from functools import wraps
-from urllib.parse import parse_qsl, urlparse
+from urllib.parse import parse_qsl, urlencode
+
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 def dash_kwarg(inputs, extra_args={}):
@@ -21,11 +26,18 @@ def apply_default_value(params):
     def wrapper(func):
         def apply_value(*args, **kwargs):
             if "id" in kwargs and kwargs["id"] in params:
-                # If raw value as string, otherwise parse as Python object (list etc)
-                try:
-                    kwargs["value"] = ast.literal_eval(params[kwargs["id"]])
-                except Exception:
-                    kwargs["value"] = params[kwargs["id"]]
+                value = params[kwargs["id"]]
+
+                # Legacy URLs hold Python reprs, decoded states are already
+                # Python objects
+                if isinstance(value, str):
+                    # If raw value as string, otherwise parse as Python object (list etc)
+                    try:
+                        value = ast.literal_eval(value)
+                    except Exception:
+                        pass
+
+                kwargs["value"] = value
 
             return func(*args, **kwargs)
 
@@ -34,8 +46,178 @@ def apply_default_value(params):
     return wrapper
 
 
-def parse_state(url):
-    parse_result = urlparse(url)
-    params = parse_qsl(parse_result.query)
-    state = dict(params)
-    return state
+url_state_version = "2"
+
+id_alphabet = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def occupation_id(occupation, length=6):
+    # Short id taken from a hash of the name, so it stays the same whichever
+    # occupations are in a year or are added in later releases
+    digest = int.from_bytes(hashlib.sha1(occupation.encode()).digest()[:8], "big")
+
+    id = ""
+    for _ in range(length):
+        digest, i = divmod(digest, len(id_alphabet))
+        id += id_alphabet[i]
+
+    return id
+
+
+def option(options, value):
+    # Option at a position from the URL, negative positions aren't valid
+    i = int(value)
+    if not 0 <= i < len(options):
+        raise IndexError(i)
+
+    return options[i]
+
+
+def percentile_option(options, value):
+    value = int(value)
+    if value not in options:
+        raise ValueError(value)
+
+    return value
+
+
+class StateCodec:
+    # Short, versioned URL state. States and scales are stored as their
+    # position in the option lists and occupations as a hash of their name,
+    # e.g. ?v=2&y=2021&s=0&p=50&c=0&o=y7sob2.8z7dld.
+    # `occupations` returns the sorted occupation list of a year.
+    def __init__(self, states, scales, percentiles, occupations):
+        self.states = list(states)
+        self.scales = list(scales)
+        self.percentiles = list(percentiles)
+        self.occupations = occupations
+        self.occupation_ids = {}
+
+    def occupation_map(self, year):
+        if year not in self.occupation_ids:
+            occs = self.occupations(year)
+            ids = {occupation_id(occ): occ for occ in occs}
+            if len(ids) != len(occs):
+                raise ValueError(f"Occupation ids collide in {year}")
+            self.occupation_ids[year] = ids
+
+        return self.occupation_ids[year]
+
+    def encode(self, state, percentile, year, scale, occupations):
+        # Values the codec doesn't know are left out so their defaults apply
+        params = {"v": url_state_version}
+
+        try:
+            year = int(year)
+            ids = self.occupation_map(year)
+            params["y"] = year
+        except (KeyError, TypeError, ValueError):
+            ids = None
+
+        if state in self.states:
+            params["s"] = self.states.index(state)
+        if percentile in self.percentiles:
+            params["p"] = int(percentile)
+        if scale in self.scales:
+            params["c"] = self.scales.index(scale)
+
+        if ids is not None:
+            # Occupations missing from the year are dropped, this only
+            # happens briefly while the year is being changed
+            params["o"] = ".".join(
+                occupation_id(occ)
+                for occ in occupations or []
+                if ids.get(occupation_id(occ)) == occ
+            )
+
+        return urlencode(params)
+
+    def parse(self, query):
+        params = dict(parse_qsl(query, keep_blank_values=True))
+
+        # Links shared before the codec hold Python reprs of each input
+        if params.get("v") != url_state_version:
+            return dict(parse_qsl(query))
+
+        return params
+
+    def normalise(self, query):
+        # Queries that decode to the same state share one form, whatever the
+        # order of their parameters
+        return urlencode(sorted(self.parse(query).items()))
+
+    def decode(self, query):
+        params = self.parse(query)
+        if params.get("v") != url_state_version:
+            return params
+
+        # Fields and occupations that fail to decode are left out so their
+        # defaults apply
+        state = {}
+        try:
+            year = int(params["y"])
+            ids = self.occupation_map(year)
+            state["dropdown_year"] = year
+            if "o" in params:
+                state["checkbox_occupations"] = [
+                    ids[x] for x in params["o"].split(".") if x in ids
+                ]
+        except (KeyError, ValueError):
+            pass
+
+        for key, param, decode in [
+            ("dropdown_state", "s", lambda x: option(self.states, x)),
+            (
+                "dropdown_percentile",
+                "p",
+                lambda x: percentile_option(self.percentiles, x),
+            ),
+            ("dropdown_scale", "c", lambda x: option(self.scales, x)),
+        ]:
+            try:
+                state[key] = decode(params[param])
+            except (KeyError, ValueError, IndexError):
+                pass
+
+        return state
+
+
+class ChunkSink(io.RawIOBase):
+    # Write-only file that hands back whatever has been written since the
+    # last drain, so a parquet file can be streamed one row group at a time
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_csv(frames, columns):
+    yield ",".join(columns) + "\n"
+    for frame in frames:
+        yield frame.to_csv(index=False, header=False, columns=columns)
+
+
+def stream_parquet(frames, schema):
+    sink = ChunkSink()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema) as writer:
+        for frame in frames:
+            writer.write_table(
+                pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+            )
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,44 @@
+function ordinal(n) {
+    const suffixes = ["th", "st", "nd", "rd"];
+    const v = n % 100;
+    return n + (suffixes[(v - 20) % 10] || suffixes[v] || suffixes[0]);
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    pcntiles: {
+        // Mirrors figure_dict in app.py
+        figure: function (store, percentile, scale) {
+            if (!store) {
+                return window.dash_clientside.no_update;
+            }
+
+            const multiplier = store.scale_options[scale];
+
+            return {
+                data: store.tables.map((table) => ({
+                    type: "scatter",
+                    x: table.x,
+                    y: table.y[percentile].map((v) => v * multiplier),
+                    name: table.name,
+                })),
+                layout: {
+                    height: 600,
+                    title: {
+                        text: `Estimated ${scale} Income of Full Time Employees<br>${store.year} - ${ordinal(percentile)} Percentile`,
+                        font: {size: 24},
+                    },
+                    yaxis: {
+                        title: {text: `${scale} Income (Estimated)`, font: {size: 18}},
+                        fixedrange: true,
+                    },
+                    xaxis: {fixedrange: true},
+                    legend: {
+                        orientation: "h",
+                        title: {text: "Occupations", side: "top", font: {size: 18}},
+                        font: {size: 16},
+                    },
+                },
+            };
+        },
+    },
+});
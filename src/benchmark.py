@@ -0,0 +1,277 @@
+import json
+import platform
+import resource
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+import pandas as pd
+
+from process_data import *
+
+
+def read_census_csv_python(filepath, column_mapping):
+    return pd.read_csv(
+        filepath,
+        index_col=False,
+        usecols=column_mapping.keys(),
+        skiprows=10,
+        skipfooter=8,
+        engine="python",
+    )
+
+
+def process_census_frame_apply(
+    data, column_mapping, incp_low_mapping, incp_high_mapping
+):
+    data = data.rename(columns=column_mapping)
+
+    data = data.fillna(method="ffill")
+
+    data = data[
+        ~data["OCCP4D"].isin(
+            ["Inadequately described", "Not stated", "Not applicable", "Total"]
+        )
+    ]
+
+    data["STATE"] = data["STATE"].replace("Total", "All")
+
+    data = data[~data["AGE10P"].isin(["Total"])]
+
+    data["INCP_LOW"] = data["INCP"].apply(lambda x: incp_low_mapping[x])
+    data["INCP_HIGH"] = data["INCP"].apply(lambda x: incp_high_mapping[x])
+
+    return data
+
+
+def best_time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def benchmark_load(repeat=3):
+    for year, (filepath, column_mapping, *_) in census_datasets.items():
+        old = best_time(
+            lambda: read_census_csv_python(filepath, column_mapping), repeat
+        )
+        new = best_time(lambda: read_census_csv(filepath, column_mapping), repeat)
+
+        print(f"{year} load: python {old:.3f}s, c {new:.3f}s ({old / new:.1f}x)")
+
+
+def benchmark_process(repeat=3):
+    for year, (filepath, column_mapping, income_tail) in census_datasets.items():
+        raw = read_census_csv(filepath, column_mapping)
+        raw_object = raw.astype(object)
+
+        # The old code looked bounds up in hand written dicts, built here once
+        # from the bracket labels so the baseline doesn't time the parsing
+        incp = [k for k, v in column_mapping.items() if v == "INCP"][0]
+        bounds = {
+            x: parse_income_bracket(x, income_tail) for x in raw[incp].dropna().unique()
+        }
+        mappings = (
+            {x: low for x, (low, _) in bounds.items()},
+            {x: high for x, (_, high) in bounds.items()},
+        )
+
+        old = best_time(
+            lambda: process_census_frame_apply(raw_object, column_mapping, *mappings),
+            repeat,
+        )
+        new = best_time(
+            lambda: process_census_frame(raw, column_mapping, income_tail), repeat
+        )
+
+        print(
+            f"{year} process: apply {old:.3f}s, vectorised {new:.3f}s ({old / new:.1f}x)"
+        )
+
+
+def benchmark_memory():
+    data = load_census_data()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    legacy = data.astype({column: object for column in census_label_columns})
+    legacy = legacy.astype(
+        {"COUNT": int, "INCP_LOW": int, "INCP_HIGH": int, "YEAR": int}
+    )
+
+    old = legacy.memory_usage(deep=True).sum() / 2**20
+    new = data.memory_usage(deep=True).sum() / 2**20
+
+    print(f"census frame: object {old:.1f}MiB, compact {new:.1f}MiB ({old / new:.1f}x)")
+    print(f"peak RSS after load: {rss:.0f}MiB")
+
+
+def benchmark_estimators(reference="binsmooth"):
+    # Accuracy of each estimator against the reference across every cell
+    cell_store = build_cell_store(load_census_data())
+
+    for year in census_datasets:
+        cells = [key for key in cell_store if key[0] == year]
+
+        times = {}
+        values = {}
+        for estimator in estimators:
+            start = timeit.default_timer()
+            pcntiles = compute_pcntiles(
+                cell_store, cells=cells, processes=1, estimator=estimator
+            )
+            times[estimator] = timeit.default_timer() - start
+            values[estimator] = pcntiles["PERCENTILE_VALUE"].values
+
+        expected = values[reference]
+        for estimator in estimators:
+            error = np.abs(values[estimator] - expected)
+            print(
+                f"{year} {estimator}: {times[estimator]:.2f}s "
+                f"({times[reference] / times[estimator]:.1f}x), "
+                f"error mean {error.mean():.3f}, p99 {np.quantile(error, 0.99):.3f}, "
+                f"max {error.max():.3f}"
+            )
+
+
+def measure(func, repeat=5, setup=None):
+    # Best of `repeat` untraced runs, then one traced run for peak memory
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"seconds": min(times), "peak_mib": peak / 2**20}
+
+
+def measure_startup():
+    # Import app.py in a fresh interpreter so nothing is already loaded
+    start = timeit.default_timer()
+    subprocess.run([sys.executable, "-c", "import app"], check=True)
+    seconds = timeit.default_timer() - start
+
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {"seconds": seconds, "peak_rss_mib": rss}
+
+
+def callback_request(app, client, name, values, changed):
+    # Call a Dash callback the way the browser does, `values` holds the
+    # inputs and states by component id
+    output, spec = next(
+        (output, spec)
+        for output, spec in app.app.callback_map.items()
+        if spec["callback"].__name__ == name
+    )
+
+    if output.startswith(".."):
+        outputs = [x.rsplit(".", 1) for x in output.strip(".").split("...")]
+        outputs = [{"id": id, "property": prop} for id, prop in outputs]
+    else:
+        id, prop = output.rsplit(".", 1)
+        outputs = {"id": id, "property": prop}
+
+    def request():
+        response = client.post(
+            "/_dash-update-component",
+            json={
+                "output": output,
+                "outputs": outputs,
+                "inputs": [dict(x, value=values[x["id"]]) for x in spec["inputs"]],
+                "state": [dict(x, value=values[x["id"]]) for x in spec["state"]],
+                "changedPropIds": [changed],
+            },
+        )
+        assert response.status_code == 200, response.status_code
+
+    return request
+
+
+def benchmark_suite(repeat=5):
+    results = {
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "estimator": pcntile_estimator,
+        "dataset_version": pcntiles_digest(),
+    }
+
+    results["process_census_data"] = {
+        str(year): measure(lambda: process_census_data(*dataset), repeat)
+        for year, dataset in census_datasets.items()
+    }
+    results["app_startup"] = measure_startup()
+
+    import app
+
+    client = app.server.test_client()
+    state, year, occupation = "All", int(app.latest_year), app.occs_default_selected[0]
+    values = {
+        "dropdown_state": state,
+        "dropdown_percentile": 50,
+        "dropdown_year": app.years[-2],
+        "store_year": year,
+        "dropdown_scale": "Annual",
+        "checkbox_occupations": app.occs_default_selected,
+        "confirm": None,
+        "button_download": 1,
+    }
+
+    results["get_pcntiles"] = {
+        "cold": measure(
+            lambda: app.get_pcntiles(state, year, occupation),
+            repeat,
+            setup=app.get_pcntiles.cache.clear,
+        ),
+        "warm": measure(lambda: app.get_pcntiles(state, year, occupation), repeat),
+    }
+    results["figure_dict"] = measure(
+        lambda: app.figure_dict(state, 50, year, "Annual", app.occs_default_selected),
+        repeat,
+    )
+
+    def clear_caches():
+        app.get_pcntiles.cache.clear()
+        app.figure_cache.clear()
+
+    update_graph = callback_request(
+        app, client, "update_graph", values, "dropdown_state.value"
+    )
+    year_change = callback_request(
+        app, client, "year_change", values, "dropdown_year.value"
+    )
+    download_plot = callback_request(
+        app, client, "download_plot", values, "button_download.n_clicks"
+    )
+
+    results["callbacks"] = {
+        "update_graph": {
+            "cold": measure(update_graph, repeat, setup=clear_caches),
+            "warm": measure(update_graph, repeat),
+        },
+        "year_change": measure(year_change, repeat),
+        "download_plot": {
+            "cold": measure(download_plot, 2, setup=app.export_cache.clear),
+            "warm": measure(download_plot, repeat),
+        },
+    }
+
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["suite"]:
+        print(json.dumps(benchmark_suite(), indent=2))
+        sys.exit()
+
+    benchmark_load()
+    benchmark_process()
+    benchmark_memory()
+    benchmark_estimators()
@@ -0,0 +1,185 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+evictions = ["lru", "fifo"]
+
+_missing = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize=128, eviction="lru"):
+        if eviction not in evictions:
+            raise ValueError(f"Unknown eviction policy: {eviction}")
+
+        self.maxsize = maxsize
+        self.eviction = eviction
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            if self.eviction == "lru":
+                self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self),
+            "maxsize": self.maxsize,
+        }
+
+
+class SqliteCache:
+    # Pickled values in a sqlite file so that every gunicorn worker shares
+    # the same entries. Hit and miss counts are per process. Keys include
+    # `version` and entries written under another version are dropped when
+    # the cache is opened, so stale workers can't serve or leave old values.
+    # Eviction order is only kept to within `touch_interval` seconds, hits
+    # on recently used entries don't write.
+    touch_interval = 60
+
+    def __init__(self, path, maxsize=4096, eviction="lru", version=None):
+        if eviction not in evictions:
+            raise ValueError(f"Unknown eviction policy: {eviction}")
+
+        self.path = path
+        self.maxsize = maxsize
+        self.eviction = eviction
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value BLOB, used REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+            if version is not None:
+                row = conn.execute(
+                    "SELECT value FROM meta WHERE key = 'version'"
+                ).fetchone()
+                if row is None or row[0] != version:
+                    conn.execute("DELETE FROM cache")
+                    conn.execute(
+                        "INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,)
+                    )
+
+    def _connect(self):
+        # Connections can't be shared across threads or forked workers
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _key(self, key):
+        return repr((self.version, key))
+
+    def get(self, key, default=None):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT value, used FROM cache WHERE key = ?", (self._key(key),)
+        ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        if self.eviction == "lru" and time.time() - row[1] > self.touch_interval:
+            with conn:
+                conn.execute(
+                    "UPDATE cache SET used = ? WHERE key = ?",
+                    (time.time(), self._key(key)),
+                )
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                (self._key(key), pickle.dumps(value), time.time()),
+            )
+            conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,),
+            )
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM cache")
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self),
+            "maxsize": self.maxsize,
+        }
+
+
+def make_cache(backend="memory", maxsize=128, eviction="lru", path=None, version=None):
+    if backend == "memory":
+        return LRUCache(maxsize, eviction)
+    if backend == "sqlite":
+        return SqliteCache(path, maxsize, eviction, version)
+
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+def cached(cache):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            value = cache.get(args, _missing)
+            if value is _missing:
+                value = func(*args)
+                cache.set(args, value)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
@@ -0,0 +1,241 @@
+import numpy as np
+from binsmooth import BinSmooth
+
+
+def row_searchsorted(knots, x, lengths):
+    # Interval index of each x within its own row of knots, clipped to the
+    # valid intervals of that row. Rows are shifted apart by their index so
+    # one flat searchsorted covers the whole batch.
+    scale = knots.max() - knots.min() + 1
+    offset = np.arange(len(knots))[:, None] * scale
+
+    idx = np.searchsorted((knots + offset).ravel(), (x + offset).ravel(), "right")
+    idx = idx.reshape(x.shape) - np.arange(len(knots))[:, None] * knots.shape[1] - 1
+
+    return np.clip(idx, 0, lengths[:, None] - 2)
+
+
+def pchip_edge_case(h0, h1, m0, m1):
+    # One-sided three-point derivative at an end point, as in scipy
+    d = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+
+    mask = np.sign(d) != np.sign(m0)
+    mask2 = (np.sign(m0) != np.sign(m1)) & (np.abs(d) > 3 * np.abs(m0))
+
+    d[mask] = 0
+    d[~mask & mask2] = 3 * m0[~mask & mask2]
+
+    return d
+
+
+def pchip_derivatives(x, y, lengths):
+    # Row-wise equivalent of scipy's PchipInterpolator derivatives. Knots past
+    # a row's length are padding and only need to be increasing.
+    rows = np.arange(len(x))
+    h = np.diff(x, axis=1)
+    m = np.diff(y, axis=1) / h
+
+    w1 = 2 * h[:, 1:] + h[:, :-1]
+    w2 = h[:, 1:] + 2 * h[:, :-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        whmean = (w1 / m[:, :-1] + w2 / m[:, 1:]) / (w1 + w2)
+
+    condition = (
+        (np.sign(m[:, 1:]) != np.sign(m[:, :-1])) | (m[:, 1:] == 0) | (m[:, :-1] == 0)
+    )
+
+    d = np.zeros_like(y)
+    with np.errstate(divide="ignore"):
+        d[:, 1:-1] = np.where(condition, 0, 1 / whmean)
+
+    # Rows with at least three knots get the end point estimates, rows with
+    # two knots are linear
+    last = lengths - 1
+    wide = lengths > 2
+    d[:, 0] = m[:, 0]
+    d[rows, last] = m[rows, last - 1]
+
+    w = rows[wide]
+    d[w, 0] = pchip_edge_case(h[w, 0], h[w, 1], m[w, 0], m[w, 1])
+    d[w, last[wide]] = pchip_edge_case(
+        h[w, last[wide] - 1],
+        h[w, last[wide] - 2],
+        m[w, last[wide] - 1],
+        m[w, last[wide] - 2],
+    )
+
+    return d
+
+
+def pchip_evaluate(x, y, d, lengths, xi):
+    # Evaluate the cubic Hermite spline of each row at that row's xi
+    rows = np.arange(len(x))[:, None]
+    k = row_searchsorted(x, xi, lengths)
+
+    x0, x1 = x[rows, k], x[rows, k + 1]
+    y0, y1 = y[rows, k], y[rows, k + 1]
+    d0, d1 = d[rows, k], d[rows, k + 1]
+
+    h = x1 - x0
+    t = (xi - x0) / h
+
+    return (
+        y0 * (1 + 2 * t) * (1 - t) ** 2
+        + h * d0 * t * (1 - t) ** 2
+        + y1 * t**2 * (3 - 2 * t)
+        + h * d1 * t**2 * (t - 1)
+    )
+
+
+def linear_evaluate(x, y, xi, lengths=None):
+    # Row-wise linear interpolation, rows are full length unless given
+    if lengths is None:
+        lengths = np.full(len(x), x.shape[1])
+    rows = np.arange(len(x))[:, None]
+    k = row_searchsorted(x, xi, lengths)
+
+    x0, x1 = x[rows, k], x[rows, k + 1]
+    y0, y1 = y[rows, k], y[rows, k + 1]
+
+    return y0 + (y1 - y0) * (xi - x0) / (x1 - x0)
+
+
+def collapse_zeros(edges, counts):
+    # Normalised ECDF knots of each histogram with a leading (0, 0) knot and
+    # zero count bins merged into the next bin, as BinSmooth is fitted.
+    # Knots past a row's length are padding above its tail. Rows with no
+    # observations are dropped and marked False in `fitted`.
+    edges = np.atleast_2d(edges).astype(float)
+    counts = np.atleast_2d(counts).astype(float)
+    if edges.shape[0] == 1:
+        edges = np.repeat(edges, len(counts), axis=0)
+
+    fitted = counts.sum(axis=1) > 0
+    edges, counts = edges[fitted], counts[fitted]
+    n, bins = counts.shape
+
+    # Keep the non-zero bins of each row first and in order
+    nonzero = counts != 0
+    order = np.argsort(~nonzero, axis=1, kind="stable")
+    lengths = nonzero.sum(axis=1) + 1
+    rows = np.arange(n)[:, None]
+
+    x = np.zeros((n, bins + 1))
+    x[:, 1:] = edges[rows, order]
+    y = np.zeros((n, bins + 1))
+    y[:, 1:] = np.cumsum(counts[rows, order], axis=1)
+    if n:
+        y /= y.max(axis=1, keepdims=True)
+
+    padding = np.arange(bins + 1) >= lengths[:, None]
+    tail = x[np.arange(n), lengths - 1]
+    x = np.where(padding, tail[:, None] + np.arange(bins + 1), x)
+    y = np.where(padding, 1, y)
+
+    return x, y, lengths, fitted
+
+
+def estimate_pcntiles_binsmooth(edges, counts, pcntiles):
+    # Reference estimator, one BinSmooth fit per histogram
+    edges = np.atleast_2d(edges)
+    counts = np.atleast_2d(counts)
+    if edges.shape[0] == 1:
+        edges = np.repeat(edges, len(counts), axis=0)
+
+    result = np.zeros((len(counts), len(pcntiles)))
+    for i, (row_edges, row_counts) in enumerate(zip(edges, counts)):
+        # If the cell has no observations then fill with 0
+        if row_counts.sum() == 0:
+            continue
+
+        # Collapse zeros
+        idx = row_counts != 0
+        bs = BinSmooth()
+        bs.fit(
+            np.concatenate(([0], row_edges[idx])),
+            np.concatenate(([0], row_counts[idx])),
+            includes_tail=True,
+        )
+        result[i] = bs.inv_cdf(np.asarray(pcntiles) / 100)
+
+    return result
+
+
+def estimate_pcntiles_batch(edges, counts, pcntiles, interp_num=1000, num=50):
+    # Vectorised BinSmooth(includes_tail=True).inv_cdf for a batch of
+    # histograms, one per row of edges/counts. Each row is fitted with the
+    # same steps as BinSmooth: a PCHIP spline through the ECDF, sampled at
+    # `interp_num` points to place `num` knots evenly in probability, and a
+    # PCHIP spline through those knots as the inverse CDF.
+    x, y, lengths, fitted = collapse_zeros(edges, counts)
+    n = len(x)
+
+    # If the cell has no observations then fill with 0
+    result = np.zeros((len(fitted), len(pcntiles)))
+    if not n:
+        return result
+
+    d = pchip_derivatives(x, y, lengths)
+
+    # cumdensityspace: knots spaced evenly in probability
+    tail = x[np.arange(n), lengths - 1]
+    xs = np.linspace(0, 1, interp_num) * tail[:, None]
+    cps = pchip_evaluate(x, y, d, lengths, xs)
+    cps[:, -1] = 1
+    x_cs = linear_evaluate(cps, xs, np.broadcast_to(np.linspace(0, 1, num), (n, num)))
+    y_cs = pchip_evaluate(x, y, d, lengths, x_cs)
+
+    # Inverse CDF
+    inv_lengths = np.full(n, num)
+    inv_d = pchip_derivatives(y_cs, x_cs, inv_lengths)
+    p = np.broadcast_to(np.clip(np.asarray(pcntiles) / 100, 0, 1), (n, len(pcntiles)))
+    result[fitted] = pchip_evaluate(y_cs, x_cs, inv_d, inv_lengths, p)
+
+    return result
+
+
+def estimate_pcntiles_linear(edges, counts, pcntiles):
+    # Uniform density within each bin, except for the top bin which follows a
+    # Pareto distribution truncated at the tail. The Pareto index is fitted
+    # to the share of observations above the lower bounds of the two top bins.
+    x, y, lengths, fitted = collapse_zeros(edges, counts)
+    n = len(x)
+
+    result = np.zeros((len(fitted), len(pcntiles)))
+    if not n:
+        return result
+
+    p = np.broadcast_to(np.clip(np.asarray(pcntiles) / 100, 0, 1), (n, len(pcntiles)))
+    values = linear_evaluate(y, x, p, lengths)
+
+    # Rows with a positive lower bound under the top bin and a decreasing
+    # share above each bound get a Pareto tail
+    rows = np.arange(n)
+    last = lengths - 1
+    top_low = x[rows, np.maximum(last - 1, 0)]
+    prev_low = x[rows, np.maximum(last - 2, 0)]
+    top_share = 1 - y[rows, np.maximum(last - 1, 0)]
+    prev_share = 1 - y[rows, np.maximum(last - 2, 0)]
+
+    tailed = (lengths > 3) & (prev_low > 0) & (prev_share > top_share)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha = np.log(prev_share / top_share) / np.log(top_low / prev_low)
+        c = (x[rows, last] / top_low) ** -alpha
+
+        r = (1 - p) / top_share[:, None]
+        pareto = top_low[:, None] * (r * (1 - c[:, None]) + c[:, None]) ** (
+            -1 / alpha[:, None]
+        )
+
+    in_tail = tailed[:, None] & (p > 1 - top_share[:, None])
+    values[in_tail] = pareto[in_tail]
+    result[fitted] = values
+
+    return result
+
+
+estimators = {
+    "binsmooth": estimate_pcntiles_binsmooth,
+    "pchip": estimate_pcntiles_batch,
+    "linear": estimate_pcntiles_linear,
+}
@@ -0,0 +1,78 @@
+import fcntl
+import os
+import time
+
+import plotly.graph_objs as go
+
+
+class ExportQueueFull(Exception):
+    pass
+
+
+def render_image(fig, format, width, height, scale):
+    return go.Figure(fig).to_image(
+        format=format,
+        width=width,
+        height=height,
+        scale=scale,
+    )
+
+
+class FileSlots:
+    # Slots held as flock()ed files, shared by every process using the same
+    # path. The kernel drops the lock when its holder exits, so a worker
+    # killed mid-render can't leak its slot.
+    def __init__(self, path, count, poll_interval=0.05):
+        self.paths = [f"{path}.{i}.lock" for i in range(count)]
+        self.poll_interval = poll_interval
+
+    def try_acquire(self):
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+
+        return None
+
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            fd = self.try_acquire()
+            if fd is not None or time.monotonic() >= deadline:
+                return fd
+            time.sleep(self.poll_interval)
+
+    def release(self, fd):
+        os.close(fd)
+
+
+class ExportRenderer:
+    # Renders images in the calling worker, kaleido keeps its Chromium
+    # subprocess alive between exports. At most `max_concurrent` exports run
+    # at once across all workers and up to `max_queued` more wait for a slot,
+    # each for at most `wait` seconds. Anything beyond that raises
+    # ExportQueueFull.
+    def __init__(self, path, max_concurrent=1, max_queued=4, wait=10):
+        self.wait = wait
+        self._slots = FileSlots(f"{path}.slot", max_concurrent)
+        self._places = FileSlots(f"{path}.place", max_concurrent + max_queued)
+
+    def render(self, fig, format="png", width=800, height=600, scale=2):
+        place = self._places.try_acquire()
+        if place is None:
+            raise ExportQueueFull
+
+        try:
+            slot = self._slots.acquire(self.wait)
+            if slot is None:
+                raise ExportQueueFull
+
+            try:
+                return render_image(fig, format, width, height, scale)
+            finally:
+                self._slots.release(slot)
+        finally:
+            self._places.release(place)
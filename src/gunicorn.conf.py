@@ -0,0 +1,7 @@
+def post_fork(server, worker):
+    # Each worker warms its own cache, threads don't survive the fork from a
+    # preloaded master
+    import app
+
+    if app.warmup_mode == "background":
+        app.start_background_warm_up()
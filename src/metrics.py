@@ -0,0 +1,113 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Histogram:
+    def __init__(self, name, help, label, buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            counts, total, observations = self._values.get(
+                label_value, ([0] * len(self.buckets), 0.0, 0)
+            )
+            counts = [c + (value <= b) for c, b in zip(counts, self.buckets)]
+            self._values[label_value] = (counts, total + value, observations + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for label_value, (counts, total, observations) in values:
+            label = f'{self.label}="{label_value}"'
+            for bucket, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{label},le="{bucket}"}} {count}')
+
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {observations}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {observations}")
+
+        return lines
+
+
+class Metrics:
+    # Opt-in timings and cache counters in the Prometheus text format. Values
+    # are per process, so each gunicorn worker reports its own.
+    def __init__(self, enabled=False, prefix="teacher_pay"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.callbacks = Histogram(
+            f"{prefix}_callback_seconds", "Time spent in Dash callbacks", "callback"
+        )
+        self.stages = Histogram(
+            f"{prefix}_stage_seconds", "Time spent in internal stages", "stage"
+        )
+        self.caches = {}
+
+    @contextmanager
+    def time(self, label_value, histogram=None):
+        if not self.enabled:
+            yield
+            return
+
+        histogram = histogram or self.stages
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(label_value, time.perf_counter() - start)
+
+    def timed(self, histogram, label_value):
+        def decorator(func):
+            if not self.enabled:
+                return func
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(label_value, histogram):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def callback(self, name):
+        return self.timed(self.callbacks, name)
+
+    def stage(self, name):
+        return self.timed(self.stages, name)
+
+    def add_cache(self, name, cache):
+        self.caches[name] = cache
+
+    def render(self):
+        lines = self.callbacks.render() + self.stages.render()
+
+        stats = {name: cache.stats() for name, cache in self.caches.items()}
+        for stat, kind, help in [
+            ("hits", "counter", "Cache hits"),
+            ("misses", "counter", "Cache misses"),
+            ("size", "gauge", "Entries in the cache"),
+            ("maxsize", "gauge", "Maximum entries in the cache"),
+        ]:
+            name = f"{self.prefix}_cache_{stat}"
+            if kind == "counter":
+                name += "_total"
+
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for cache, values in stats.items():
+                lines.append(f'{name}{{cache="{cache}"}} {values[stat]}')
+
+        return "\n".join(lines) + "\n"
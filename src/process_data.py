@@ -1,164 +1,593 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import threading
 import warnings
-from multiprocessing import Pool, cpu_count, get_context
+from multiprocessing import cpu_count, get_context
 
 warnings.simplefilter("ignore", UserWarning)
 
 import numpy as np
 import pandas as pd
-from binsmooth import BinSmooth
-
-column_mapping_2021 = {
-    "4-digit level OCCP Occupation": "OCCP4D",
-    "INCP Total Personal Income (weekly)": "INCP",
-    "AGE10P Age in Ten Year Groups": "AGE10P",
-    "STATE (POW)": "STATE",
-    "Unnamed: 4": "COUNT",
-}
-
-column_mapping_2016 = {
-    "OCCP - 4 Digit Level": "OCCP4D",
-    "INCP Total Personal Income (weekly)": "INCP",
-    "AGE10P - Age in Ten Year Groups": "AGE10P",
-    "STATE (POW)": "STATE",
-    "Unnamed: 4": "COUNT",
-}
-
-column_mapping_2011 = {
-    "OCCP Occupation": "OCCP4D",
-    "INCP Total Personal Income (weekly)": "INCP",
-    "AGE10P  Age in Ten Year Groups": "AGE10P",
-    "Main Statistical Area Structure (Main ASGS) (POW)": "STATE",
-    "Unnamed: 4": "COUNT",
-}
-
-column_mapping_2006 = {
-    "OCC06P Occupation 06 (ANZSCO)": "OCCP4D",
-    "INCP Individual Income (gross weekly)": "INCP",
-    "AGEP Age (10 Year Groups)": "AGE10P",
-    "Main ASGC": "STATE",
-    "Unnamed: 4": "COUNT",
-}
-
-incp_low_mapping_2021 = {
-    "$400-$499 ($20,800-$25,999)": 400,
-    "$500-$649 ($26,000-$33,799)": 500,
-    "$650-$799 ($33,800-$41,599)": 600,
-    "$800-$999 ($41,600-$51,999)": 800,
-    "$1,000-$1,249 ($52,000-$64,999)": 1000,
-    "$1,250-$1,499 ($65,000-$77,999)": 1250,
-    "$1,500-$1,749 ($78,000-$90,999)": 1500,
-    "$1,750-$1,999 ($91,000-$103,999)": 1750,
-    "$2,000-$2,999 ($104,000-$155,999)": 2000,
-    "$3,000-$3,499 ($156,000-$181,999)": 3000,
-    "$3,500 or more ($182,000 or more)": 3500,
-}
-
-incp_high_mapping_2021 = {
-    "$400-$499 ($20,800-$25,999)": 499,
-    "$500-$649 ($26,000-$33,799)": 649,
-    "$650-$799 ($33,800-$41,599)": 799,
-    "$800-$999 ($41,600-$51,999)": 999,
-    "$1,000-$1,249 ($52,000-$64,999)": 1249,
-    "$1,250-$1,499 ($65,000-$77,999)": 1499,
-    "$1,500-$1,749 ($78,000-$90,999)": 1749,
-    "$1,750-$1,999 ($91,000-$103,999)": 1999,
-    "$2,000-$2,999 ($104,000-$155,999)": 2999,
-    "$3,000-$3,499 ($156,000-$181,999)": 3499,
-    "$3,500 or more ($182,000 or more)": 7000,
-}
-
-incp_low_mapping_2016 = {
-    "$400-$499 ($20,800-$25,999)": 400,
-    "$500-$649 ($26,000-$33,799)": 500,
-    "$650-$799 ($33,800-$41,599)": 600,
-    "$800-$999 ($41,600-$51,999)": 800,
-    "$1,000-$1,249 ($52,000-$64,999)": 1000,
-    "$1,250-$1,499 ($65,000-$77,999)": 1250,
-    "$1,500-$1,749 ($78,000-$90,999)": 1500,
-    "$1,750-$1,999 ($91,000-$103,999)": 1750,
-    "$2,000-$2,999 ($104,000-$155,999)": 2000,
-    "$3,000 or more ($156,000 or more)": 3000,
-}
-
-incp_high_mapping_2016 = {
-    "$400-$499 ($20,800-$25,999)": 499,
-    "$500-$649 ($26,000-$33,799)": 649,
-    "$650-$799 ($33,800-$41,599)": 799,
-    "$800-$999 ($41,600-$51,999)": 999,
-    "$1,000-$1,249 ($52,000-$64,999)": 1249,
-    "$1,250-$1,499 ($65,000-$77,999)": 1499,
-    "$1,500-$1,749 ($78,000-$90,999)": 1749,
-    "$1,750-$1,999 ($91,000-$103,999)": 1999,
-    "$2,000-$2,999 ($104,000-$155,999)": 2999,
-    "$3,000 or more ($156,000 or more)": 7000,
-}
-
-incp_low_mapping_2011 = {
-    "$400-$599 ($20,800-$31,199)": 400,
-    "$600-$799 ($31,200-$41,599)": 600,
-    "$800-$999 ($41,600-$51,999)": 800,
-    "$1,000-$1,249 ($52,000-$64,999)": 1000,
-    "$1,250-$1,499 ($65,000-$77,999)": 1250,
-    "$1,500-$1,999 ($78,000-$103,999)": 1500,
-    "$2,000 or more ($104,000 or more)": 2000,
-}
-
-incp_high_mapping_2011 = {
-    "$400-$599 ($20,800-$31,199)": 599,
-    "$600-$799 ($31,200-$41,599)": 799,
-    "$800-$999 ($41,600-$51,999)": 999,
-    "$1,000-$1,249 ($52,000-$64,999)": 1249,
-    "$1,250-$1,499 ($65,000-$77,999)": 1499,
-    "$1,500-$1,999 ($78,000-$103,999)": 1999,
-    "$2,000 or more ($104,000 or more)": 7000,
-}
-
-incp_low_mapping_2006 = {
-    "$400-$599": 400,
-    "$600-$799": 600,
-    "$800-$999": 800,
-    "$1,000-$1,299": 1000,
-    "$1,300-$1,599": 1300,
-    "$1,600-$1,999": 1600,
-    "$2,000 or more": 2000,
-}
-
-incp_high_mapping_2006 = {
-    "$400-$599": 599,
-    "$600-$799": 799,
-    "$800-$999": 999,
-    "$1,000-$1,299": 1299,
-    "$1,300-$1,599": 1599,
-    "$1,600-$1,999": 1999,
-    "$2,000 or more": 7000,
-}
-
-
-def process_census_data(filepath, column_mapping, incp_low_mapping, incp_high_mapping):
-    data = pd.read_csv(
+import yaml
+from pandas.api.types import union_categoricals
+from pyarrow import feather
+
+from cache import LRUCache
+from estimators import estimators
+
+# One YAML file per census year declares its TableBuilder export
+census_registry_path = "data/census"
+
+census_skiprows = 10
+
+# Rows per chunk when streaming census files
+census_chunksize = int(os.environ.get("CENSUS_CHUNKSIZE", 100_000))
+
+census_label_columns = ["OCCP4D", "INCP", "AGE10P", "STATE"]
+
+
+def count_census_rows(filepath, skiprows=census_skiprows):
+    # The table starts at the first non-blank line after the title rows and
+    # ends at the next blank line, the remaining lines are the ABS footer
+    header = None
+    with open(filepath, encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if i < skiprows:
+                continue
+            if header is None:
+                if line.strip():
+                    header = i
+            elif not line.strip():
+                return i - header - 1
+
+    return None
+
+
+def read_census_csv(filepath, column_mapping, chunksize=None):
+    label_columns = [k for k, v in column_mapping.items() if v in census_label_columns]
+
+    return pd.read_csv(
         filepath,
         index_col=False,
         usecols=column_mapping.keys(),
-        skiprows=10,
-        skipfooter=8,
-        engine="python",
+        skiprows=census_skiprows,
+        nrows=count_census_rows(filepath),
+        dtype={k: "category" for k in label_columns},
+        engine="c",
+        chunksize=chunksize,
     )
 
+
+def read_census_chunks(filepath, column_mapping, chunksize=census_chunksize):
+    label_columns = [k for k, v in column_mapping.items() if v in census_label_columns]
+
+    labels = {}
+    with read_census_csv(filepath, column_mapping, chunksize) as reader:
+        for chunk in reader:
+            # Row labels are only written when they change, so the first rows
+            # of a chunk continue the last labels of the previous chunk
+            for column, value in labels.items():
+                if pd.isna(chunk[column].iloc[0]):
+                    if value not in chunk[column].cat.categories:
+                        chunk[column] = chunk[column].cat.add_categories([value])
+                    chunk.loc[chunk.index[0], column] = value
+
+            for column in label_columns:
+                last = chunk[column].last_valid_index()
+                if last is not None:
+                    labels[column] = chunk.at[last, column]
+
+            yield chunk
+
+
+# "$1,000-$1,249 ($52,000-$64,999)", "$3,500 or more ($182,000 or more)"
+income_bracket_pattern = re.compile(r"\$([\d,]+)(?:-\$([\d,]+)| or more)")
+
+
+def parse_income_bracket(label, income_tail):
+    match = income_bracket_pattern.match(label)
+    if match is None:
+        raise ValueError(f"Unrecognised income bracket: {label}")
+
+    low = int(match[1].replace(",", ""))
+    high = int(match[2].replace(",", "")) if match[2] else income_tail
+
+    return low, high
+
+
+def map_categories(column, func):
+    # Evaluate each category once and broadcast via the category codes
+    column = column.cat.remove_unused_categories()
+    values = np.array([func(x) for x in column.cat.categories], dtype=np.int64)
+
+    return values[column.cat.codes.values]
+
+
+def process_census_frame(data, column_mapping, income_tail):
     data = data.rename(columns=column_mapping)
 
+    # Categorical fill and isin operate on the integer codes
     data = data.fillna(method="ffill")
 
     data = data[
         ~data["OCCP4D"].isin(
             ["Inadequately described", "Not stated", "Not applicable", "Total"]
         )
-    ]
+        & ~data["AGE10P"].isin(["Total"])
+    ].copy()
 
-    data["STATE"] = data["STATE"].replace("Total", "All")
+    data["STATE"] = data["STATE"].cat.rename_categories({"Total": "All"})
 
-    data = data[~data["AGE10P"].isin(["Total"])]
+    data["INCP_LOW"] = map_categories(
+        data["INCP"], lambda x: parse_income_bracket(x, income_tail)[0]
+    )
+    data["INCP_HIGH"] = map_categories(
+        data["INCP"], lambda x: parse_income_bracket(x, income_tail)[1]
+    )
 
-    data["INCP_LOW"] = data["INCP"].apply(lambda x: incp_low_mapping[x])
-    data["INCP_HIGH"] = data["INCP"].apply(lambda x: incp_high_mapping[x])
+    # Store counts and income bounds in the smallest integer dtypes
+    for column in ["COUNT", "INCP_LOW", "INCP_HIGH"]:
+        data[column] = pd.to_numeric(data[column], downcast="integer")
 
     return data
+
+
+def process_census_data(filepath, column_mapping, income_tail):
+    data = read_census_csv(filepath, column_mapping)
+
+    return process_census_frame(data, column_mapping, income_tail)
+
+
+# Bump when process_census_data changes so that cached frames are rebuilt
+census_cache_version = 4
+
+
+def census_cache_key(filepath, column_mapping, income_tail):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+    config = [census_cache_version, column_mapping, income_tail]
+    h.update(json.dumps(config, sort_keys=True).encode())
+
+    return h.hexdigest()[:16]
+
+
+def census_cache_path(filepath, column_mapping, income_tail):
+    key = census_cache_key(filepath, column_mapping, income_tail)
+    return f"{os.path.splitext(filepath)[0]}.{key}.feather"
+
+
+def load_census_data_cached(filepath, column_mapping, income_tail):
+    root = os.path.splitext(filepath)[0]
+    cache_path = census_cache_path(filepath, column_mapping, income_tail)
+
+    if os.path.exists(cache_path):
+        return feather.read_feather(cache_path, memory_map=True)
+
+    data = process_census_data(filepath, column_mapping, income_tail).reset_index(
+        drop=True
+    )
+
+    # Drop frames cached from previous versions of the file or mappings
+    for path in glob.glob(f"{root}.*.feather"):
+        if path != cache_path:
+            os.remove(path)
+
+    # Write then rename so concurrent workers never read a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    data.to_feather(tmp_path)
+    os.replace(tmp_path, cache_path)
+
+    return data
+
+
+def load_census_registry(path=census_registry_path):
+    # Newest year first
+    datasets = {}
+    for config_path in glob.glob(os.path.join(path, "*.yaml")):
+        with open(config_path, encoding="utf-8") as f:
+            config = yaml.safe_load(f)
+
+        datasets[config["year"]] = (
+            config["file"],
+            config["columns"],
+            config["income_tail"],
+        )
+
+    return dict(sorted(datasets.items(), reverse=True))
+
+
+census_datasets = load_census_registry()
+
+cell_columns = ["YEAR", "STATE", "OCCP4D", "AGE10P"]
+
+pcntile_range = np.arange(0, 101, 10)
+
+pcntiles_path = "data/pcntiles.parquet"
+pcntiles_manifest_path = "data/pcntiles.manifest.json"
+
+# Bump when compute_pcntiles changes so that every cell is refitted
+pcntiles_version = 1
+pcntile_estimator = os.environ.get("PCNTILE_ESTIMATOR", "pchip")
+
+
+def ingest_census_data(datasets=census_datasets, processes=None):
+    # Build the cached frames of new or changed files in parallel, one file
+    # per process
+    pending = [
+        dataset
+        for dataset in datasets.values()
+        if not os.path.exists(census_cache_path(*dataset))
+    ]
+
+    processes = min(processes or cpu_count(), len(pending))
+    if processes > 1:
+        with get_context("fork").Pool(processes) as pool:
+            pool.starmap(ingest_census_file, pending)
+    else:
+        for dataset in pending:
+            ingest_census_file(*dataset)
+
+
+def ingest_census_file(filepath, column_mapping, income_tail):
+    # Workers only write the cache, the frame is read back by the caller
+    load_census_data_cached(filepath, column_mapping, income_tail)
+
+
+def load_census_data(datasets=census_datasets):
+    ingest_census_data(datasets)
+
+    frames = []
+    for year, dataset in datasets.items():
+        data = load_census_data_cached(*dataset)
+        data["YEAR"] = np.int16(year)
+        frames.append(data)
+
+    # Share categories across years so that the concatenated label columns
+    # stay categorical instead of falling back to object
+    for column in census_label_columns:
+        categories = union_categoricals(
+            [data[column] for data in frames], sort_categories=True
+        ).categories
+        for data in frames:
+            data[column] = data[column].cat.set_categories(categories)
+
+    return pd.concat(frames, axis=0, ignore_index=True)
+
+
+def census_version():
+    h = hashlib.sha256()
+    for dataset in census_datasets.values():
+        h.update(census_cache_key(*dataset).encode())
+    h.update(pcntile_range.tobytes())
+    h.update(pcntile_estimator.encode())
+
+    return h.hexdigest()[:16]
+
+
+def pcntiles_digest(path=pcntiles_path):
+    # Version of the percentiles being served, read from the precomputed file
+    # rather than the census files it was built from
+    if not os.path.exists(path):
+        return census_version()
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+    return h.hexdigest()[:16]
+
+
+def build_cell_store(data):
+    data = data.sort_values("INCP_HIGH", ascending=True)
+    edges = data["INCP_HIGH"].values
+    counts = data["COUNT"].values
+
+    groups = data.groupby(cell_columns, observed=True, sort=False).indices
+
+    return {key: (edges[idx], counts[idx]) for key, idx in groups.items()}
+
+
+def merge_counts(parts):
+    counts = pd.concat(parts)
+    return counts.groupby(level=counts.index.names).sum()
+
+
+def stream_cell_store(datasets=census_datasets, chunksize=census_chunksize):
+    # Build the cell store chunk by chunk, memory is bounded by the number of
+    # cells and brackets rather than the number of rows in the files
+    totals = []
+    for year, (filepath, column_mapping, income_tail) in datasets.items():
+        parts = []
+        for chunk in read_census_chunks(filepath, column_mapping, chunksize):
+            data = process_census_frame(chunk, column_mapping, income_tail)
+            if data.empty:
+                continue
+            data["YEAR"] = np.int16(year)
+
+            parts.append(
+                data.groupby(cell_columns + ["INCP_HIGH"], observed=True)["COUNT"].sum()
+            )
+
+            # Merge the partial sums once they outgrow the running total, so
+            # each row is merged a bounded number of times
+            if sum(map(len, parts[1:])) > len(parts[0]):
+                parts = [merge_counts(parts)]
+
+        if parts:
+            totals.append(merge_counts(parts).reset_index())
+
+    data = pd.concat(totals, ignore_index=True)
+    for column in ["COUNT", "INCP_HIGH"]:
+        data[column] = pd.to_numeric(data[column], downcast="integer")
+    for column in ["STATE", "OCCP4D", "AGE10P"]:
+        data[column] = data[column].astype("category")
+
+    return build_cell_store(data)
+
+
+def estimate_batch(histograms, estimator=pcntile_estimator):
+    edges, counts = zip(*histograms)
+    return estimators[estimator](np.stack(edges), np.stack(counts), pcntile_range)
+
+
+def compute_pcntiles(
+    cell_store, cells=None, processes=None, batchsize=1024, estimator=pcntile_estimator
+):
+    if estimator not in estimators:
+        raise ValueError(f"Unknown percentile estimator: {estimator}")
+
+    keys = list(cell_store.keys()) if cells is None else list(cells)
+    histograms = [cell_store[key] for key in keys]
+
+    # Cells are fitted in batches of histograms with the same number of bins,
+    # a year's cells all share the same brackets
+    batches = {}
+    for i, (edges, _) in enumerate(histograms):
+        batches.setdefault(len(edges), []).append(i)
+    batches = [
+        idx[start : start + batchsize]
+        for idx in batches.values()
+        for start in range(0, len(idx), batchsize)
+    ]
+    batch_histograms = [[histograms[i] for i in idx] for idx in batches]
+
+    processes = processes or cpu_count()
+    if processes > 1 and len(batches) > 1:
+        # Fork so that workers don't re-import the calling module
+        with get_context("fork").Pool(min(processes, len(batches))) as pool:
+            results = pool.starmap(
+                estimate_batch,
+                [(histograms, estimator) for histograms in batch_histograms],
+            )
+    else:
+        results = [
+            estimate_batch(histograms, estimator) for histograms in batch_histograms
+        ]
+
+    values = np.zeros((len(keys), len(pcntile_range)))
+    for idx, result in zip(batches, results):
+        values[idx] = result
+
+    cells = pd.DataFrame(keys, columns=cell_columns)
+    cells = cells.loc[cells.index.repeat(len(pcntile_range))].reset_index(drop=True)
+
+    pcntiles = pd.concat(
+        [
+            pd.Series(np.tile(pcntile_range, len(keys)), name="PERCENTILE"),
+            pd.Series(values.ravel().round(4), name="PERCENTILE_VALUE"),
+            cells,
+        ],
+        axis=1,
+    )
+
+    return pcntiles.astype(
+        {
+            "PERCENTILE": "int8",
+            "YEAR": "int16",
+            "OCCP4D": "category",
+            "AGE10P": "category",
+            "STATE": "category",
+        }
+    )
+
+
+def cell_fingerprint(edges, counts):
+    # Independent of the integer dtypes the columns were downcast to
+    h = hashlib.sha256(np.asarray(edges, dtype=np.int64).tobytes())
+    h.update(np.asarray(counts, dtype=np.int64).tobytes())
+
+    return h.hexdigest()[:16]
+
+
+def update_pcntiles(
+    cell_store,
+    path=pcntiles_path,
+    manifest_path=pcntiles_manifest_path,
+    estimator=pcntile_estimator,
+    **kwargs,
+):
+    # Refit only the cells whose histogram changed since the manifest was
+    # written and reuse the existing estimates of the others
+    version = [pcntiles_version, estimator, pcntile_range.tolist()]
+    fingerprints = {
+        "|".join(map(str, key)): cell_fingerprint(*histogram)
+        for key, histogram in cell_store.items()
+    }
+
+    previous = {}
+    if os.path.exists(path) and os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["version"] == version:
+            previous = manifest["cells"]
+
+    keys = list(cell_store)
+    stale = [
+        key
+        for key, fingerprint in zip(keys, fingerprints.values())
+        if previous.get("|".join(map(str, key))) != fingerprint
+    ]
+    fitted = compute_pcntiles(cell_store, cells=stale, estimator=estimator, **kwargs)
+
+    frames = [fitted]
+    reused = len(keys) - len(stale)
+    if reused:
+        existing = pd.read_parquet(path)
+        stale_index = pd.MultiIndex.from_tuples(stale, names=cell_columns)
+        cells = pd.MultiIndex.from_frame(existing[cell_columns])
+        frames.append(
+            existing[
+                cells.isin(pd.MultiIndex.from_tuples(keys)) & ~cells.isin(stale_index)
+            ]
+        )
+
+    # Same row order and dtypes as a full rebuild
+    pcntiles = pd.concat(frames, ignore_index=True)
+    for column in ["STATE", "OCCP4D", "AGE10P"]:
+        pcntiles[column] = pcntiles[column].astype(str).astype("category")
+    position = pd.MultiIndex.from_tuples(keys).get_indexer(
+        pd.MultiIndex.from_frame(pcntiles[cell_columns])
+    )
+    pcntiles = (
+        pcntiles.assign(POSITION=position)
+        .sort_values(["POSITION", "PERCENTILE"])
+        .drop(columns="POSITION")
+        .reset_index(drop=True)[fitted.columns]
+    )
+
+    # Write then rename so readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    pcntiles.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": version, "cells": fingerprints}, f)
+    os.replace(tmp_path, manifest_path)
+
+    report = {
+        "cells": len(keys),
+        "reused": reused,
+        "fitted": len(stale),
+        "removed": len(set(previous) - set(fingerprints)),
+    }
+
+    return pcntiles, report
+
+
+class CensusYears:
+    # Percentile tables per census year, loaded on first use from the
+    # precomputed file or fitted from that year's census file. The latest
+    # year is kept loaded, at most `maxsize` other years are kept alongside it.
+    def __init__(self, datasets=census_datasets, path=pcntiles_path, maxsize=2):
+        self.datasets = datasets
+        self.path = path
+        self.years = sorted(datasets)
+        self.latest = max(datasets)
+        self._tables = LRUCache(maxsize)
+        self._occupations = self.occupation_index()
+        self._lock = threading.Lock()
+        self._year_locks = {}
+        self._latest_table = self.load(self.latest)
+
+    def occupation_index(self):
+        # Occupations of every year from two columns of the precomputed file,
+        # so switching years never needs a table loaded
+        if not os.path.exists(self.path):
+            return {}
+
+        data = pd.read_parquet(self.path, columns=["YEAR", "OCCP4D"])
+        return {
+            int(year): sorted(occupations.unique())
+            for year, occupations in data.groupby("YEAR", observed=True)["OCCP4D"]
+        }
+
+    def read(self, year, states=None):
+        filters = [("YEAR", "==", year)]
+        if states:
+            filters.append(("STATE", "in", list(states)))
+        table = pd.read_parquet(self.path, filters=filters)
+
+        return table.drop(columns="YEAR").set_index(["STATE", "OCCP4D"]).sort_index()
+
+    def load(self, year):
+        if os.path.exists(self.path):
+            table = self.read(year)
+        else:
+            # Fitted serially, this runs inside a web worker
+            warnings.warn(
+                f"{self.path} not found, fitting {year} percentiles on request. "
+                "Run process_data.py to precompute them.",
+                RuntimeWarning,
+            )
+            data = load_census_data_cached(*self.datasets[year])
+            data["YEAR"] = np.int16(year)
+            table = compute_pcntiles(build_cell_store(data), processes=1)
+            table = table.drop(columns="YEAR").set_index(["STATE", "OCCP4D"])
+            table = table.sort_index()
+
+        self._occupations.setdefault(year, sorted(table.index.unique("OCCP4D")))
+
+        return table
+
+    def pcntiles(self, year):
+        year = int(year)
+        if year == self.latest:
+            return self._latest_table
+        if year not in self.datasets:
+            raise KeyError(year)
+
+        table = self._tables.get(year)
+        if table is None:
+            # Concurrent first requests for a year load it once, without
+            # holding up requests for other years
+            with self._lock:
+                lock = self._year_locks.setdefault(year, threading.Lock())
+            with lock:
+                table = self._tables.get(year)
+                if table is None:
+                    table = self.load(year)
+                    self._tables.set(year, table)
+
+        return table
+
+    def scan(self, year, states=None):
+        # One-off reads of a year, e.g. exports, come straight from the
+        # precomputed file so they don't evict the years loaded for the app
+        year = int(year)
+        if year == self.latest or not os.path.exists(self.path):
+            table = self.pcntiles(year)
+            if states:
+                table = table[table.index.get_level_values("STATE").isin(states)]
+            return table
+
+        return self.read(year, states)
+
+    def occupations(self, year):
+        # Without the precomputed file the year's table is loaded instead
+        year = int(year)
+        if year not in self._occupations:
+            self.pcntiles(year)
+
+        return self._occupations[year]
+
+
+if __name__ == "__main__":
+    # Stream the census files when they are too large to load whole
+    if os.environ.get("CENSUS_STREAM", "0") == "1":
+        cell_store = stream_cell_store()
+    else:
+        cell_store = build_cell_store(load_census_data())
+
+    _, report = update_pcntiles(cell_store)
+    print(
+        f"{report['cells']} cells: {report['reused']} reused, "
+        f"{report['fitted']} fitted, {report['removed']} removed"
+    )